@@ -2,27 +2,95 @@ import os
 import json
 import re
 import uuid
-from flask import Flask, request, jsonify
-from flask_cors import CORS
+import asyncio
+import functools
+import hashlib
+import math
+import multiprocessing
+import pickle
+import shutil
+import stat
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import faiss
+import numpy as np
+import orjson
+import redis
+import tiktoken
+from quart import Quart, Response, request, jsonify
+from quart.json.provider import DefaultJSONProvider
+from quart_cors import cors
 from werkzeug.utils import secure_filename
 from langchain_google_genai import GoogleGenerativeAIEmbeddings, ChatGoogleGenerativeAI
 from langchain.vectorstores import FAISS
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.document_loaders import PyPDFLoader
-from langchain.chains import LLMChain
 from langchain.prompts import PromptTemplate
+from langchain_core.embeddings import Embeddings
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.caches import InMemoryCache
+from langchain_core.outputs import Generation
+from langchain_community.cache import SQLiteCache, RedisCache
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores.utils import DistanceStrategy
+from pdf_parsing import count_pages, load_chunks
 
-# --- 1. SET UP THE FLASK APP ---
-app = Flask(__name__)
-CORS(app, origins=["https://docu-scan-ai-ip1a.vercel.app", "http://localhost:3000"])
-# Create a temporary folder for uploads
-UPLOAD_FOLDER = 'temp_uploads'
+# --- 1. SET UP THE QUART APP ---
+# Quart is Flask's async counterpart, so LLM and embedding calls from many
+# requests can be in flight on a single worker.
+class OrjsonProvider(DefaultJSONProvider):
+    """Encodes and decodes request and response JSON with orjson."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+app = Quart(__name__)
+app.json = OrjsonProvider(app)
+# Quart defaults to a 16 MiB body limit and 60 s body/response timeouts, which
+# Flask never had. Lift the size limit and match vercel.json's 300 s maxDuration.
+app.config['MAX_CONTENT_LENGTH'] = None
+app.config['BODY_TIMEOUT'] = 300
+app.config['RESPONSE_TIMEOUT'] = 300
+app = cors(app, allow_origin=["https://docu-scan-ai-ip1a.vercel.app", "http://localhost:3000"])
+# Create a temporary folder for uploads, in RAM-backed /dev/shm when available
+if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+    UPLOAD_FOLDER = '/dev/shm/uploads'
+else:
+    UPLOAD_FOLDER = os.path.join(tempfile.gettempdir(), 'uploads')
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+# Uploaded files are deleted in the background, off the request path
+CLEANUP_POOL = ThreadPoolExecutor()
+
+
+def remove_upload_dir(upload_dir):
+    """Deletes a request's upload directory, logging rather than raising on errors."""
+    try:
+        shutil.rmtree(upload_dir)
+    except OSError as e:
+        print(f"Error removing uploaded files: {e}")
+
+
+def private_dir(path):
+    """Creates path if needed and checks that only the current user can access it."""
+    # Saved indexes are unpickled from here, so a directory another local user
+    # created first (e.g. under a shared /tmp) must never be trusted
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode):
+        raise PermissionError(f"{path} is not a directory")
+    if os.name == "posix" and (info.st_uid != os.getuid() or info.st_mode & 0o077):
+        raise PermissionError(f"{path} must be owned by the current user with mode 0700")
+    return path
 
-# In-memory storage for user vector stores (for demo purposes)
-# A more robust solution would use a database or a proper cache
+# In-memory storage for user vector stores, used when Redis is not configured.
+# With REDIS_URL set, sessions are stored in Redis and shared by all workers.
 vector_stores = {}
 
 # --- 2. SECURELY LOAD THE API KEY ---
@@ -35,48 +103,555 @@ try:
 except Exception as e:
     print(f"Error loading API Key: {e}")
 
-# --- 3. CREATE THE API ENDPOINTS ---
+# --- 3. SET UP THE EMBEDDINGS AND CACHES ---
+class LangchainEmbeddingAdapter(Embeddings):
+    """Exposes a local int8-quantized CTranslate2 encoder through LangChain's Embeddings interface."""
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self._model = None
+        self._model_lock = threading.Lock()
+
+    @property
+    def model(self):
+        # Loaded on first use: processes that only import this module, such as PDF
+        # workers spawned under `python app.py`, never load it
+        with self._model_lock:
+            if self._model is None:
+                # Imported here so the Google backend does not need the CTranslate2/torch stack
+                import ctranslate2
+                from hf_hub_ctranslate2 import CT2SentenceTransformer
+
+                if ctranslate2.get_cuda_device_count() > 0:
+                    device, compute_type = "cuda", "int8_float16"
+                else:
+                    device, compute_type = "cpu", "int8"
+                self._model = CT2SentenceTransformer(self.model_name, device=device, compute_type=compute_type)
+            return self._model
+
+    def embed_documents(self, texts):
+        vectors = self.model.encode(texts, convert_to_numpy=True, normalize_embeddings=True)
+        return vectors.tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+# Embeddings run locally by default, avoiding a network round-trip per query.
+# Set EMBEDDING_BACKEND=google to use the Google embedding API instead.
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "local")
+if EMBEDDING_BACKEND == "google":
+    EMBEDDING_MODEL = "models/embedding-001"
+    embeddings = GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL)
+else:
+    EMBEDDING_MODEL = "BAAI/bge-small-en-v1.5"
+    embeddings = LangchainEmbeddingAdapter(EMBEDDING_MODEL)
+
+# Vectors are L2-normalized and searched by inner product, which equals cosine
+# similarity and uses FAISS's faster IP kernels. Searches use every core.
+DISTANCE_STRATEGY = DistanceStrategy.MAX_INNER_PRODUCT
+faiss.omp_set_num_threads(os.cpu_count())
+
+
+def normalize(vectors):
+    """Returns the vectors as a float32 array scaled to unit length."""
+    vectors = np.array(vectors, dtype=np.float32)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+# Query embeddings are cached in Redis when REDIS_URL is set so every worker
+# shares them; otherwise a small in-process cache is used.
+REDIS_URL = os.getenv("REDIS_URL")
+redis_client = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+EMBEDDING_CACHE_TTL = 30 * 24 * 60 * 60  # 30 days
+EMBEDDING_CACHE_SIZE = 1024
+# Bump when the stored vectors change (v2: L2-normalized) so stale entries are ignored
+EMBEDDING_CACHE_PREFIX = "emb:v2:"
+embedding_cache = {}
+
+
+async def embed_query(query):
+    """Returns the embedding for a query, reusing a cached vector on repeat queries."""
+    key = EMBEDDING_CACHE_PREFIX + hashlib.blake2b(f"{EMBEDDING_MODEL}\0{query}".encode("utf-8")).hexdigest()
+
+    # Cache errors are treated as misses so a Redis outage does not fail queries
+    if redis_client:
+        try:
+            cached = await asyncio.to_thread(redis_client.get, key)
+        except redis.RedisError as e:
+            print(f"Error reading embedding cache: {e}")
+            cached = None
+    else:
+        cached = embedding_cache.get(key)
+    if cached is not None:
+        return np.frombuffer(cached, dtype=np.float32).tolist()
+
+    vector = normalize([await embeddings.aembed_query(query)])[0]
+    payload = vector.tobytes()
+    if redis_client:
+        try:
+            await asyncio.to_thread(redis_client.set, key, payload, ex=EMBEDDING_CACHE_TTL)
+        except redis.RedisError as e:
+            print(f"Error writing embedding cache: {e}")
+    else:
+        if len(embedding_cache) >= EMBEDDING_CACHE_SIZE:
+            # Dicts keep insertion order, so this evicts the oldest entry
+            embedding_cache.pop(next(iter(embedding_cache)))
+        embedding_cache[key] = payload
+    return vector.tolist()
+
+# Identical (context, query) prompts are answered from the LLM cache instead of
+# calling Gemini again. Redis is shared across workers; SQLite is per instance.
+# Streaming bypasses LangChain's global cache, so /query reads and writes it itself.
+# Cached prompts contain users' document text, so Redis entries expire; the
+# SQLite file lives in a private temp directory so read-only deploys still start.
+LLM_CACHE_TTL = 24 * 60 * 60  # 1 day
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH")
+if redis_client:
+    llm_cache = RedisCache(redis_client, ttl=LLM_CACHE_TTL)
+else:
+    try:
+        if not LLM_CACHE_PATH:
+            cache_dir = private_dir(os.path.join(tempfile.gettempdir(), "langchain_cache"))
+            LLM_CACHE_PATH = os.path.join(cache_dir, "cache.db")
+        llm_cache = SQLiteCache(database_path=LLM_CACHE_PATH)
+    except Exception as e:
+        print(f"Error opening LLM cache, falling back to memory: {e}")
+        llm_cache = InMemoryCache()
+
+# PDF parsing is CPU-bound, so uploaded files are parsed in parallel processes,
+# with large PDFs split into page windows so one file spreads across workers.
+# Workers are spawned rather than forked, since forking a process that already
+# runs an event loop and native thread pools can deadlock the child. The pool
+# is started on first use; where processes are unavailable (e.g. no /dev/shm
+# for semaphores) PDFs are parsed in threads instead.
+PDF_PAGE_WINDOW = 25
+pdf_pool = None
+pdf_pool_unavailable = False
+
+
+def get_pdf_pool():
+    """Returns the process pool that PDFs are parsed on, or None if processes are unavailable."""
+    global pdf_pool, pdf_pool_unavailable
+    if pdf_pool is None and not pdf_pool_unavailable:
+        try:
+            pdf_pool = ProcessPoolExecutor(
+                max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn")
+            )
+        except (OSError, NotImplementedError) as e:
+            print(f"Error starting PDF worker processes, parsing in threads: {e}")
+            pdf_pool_unavailable = True
+    return pdf_pool
+
+
+async def parse_pages(file_path, start, stop):
+    """Parses a window of PDF pages into text chunks, replacing the pool if a worker died."""
+    global pdf_pool
+    pool = get_pdf_pool()
+    if pool is None:
+        return await asyncio.to_thread(load_chunks, file_path, start, stop)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, load_chunks, file_path, start, stop)
+    except BrokenProcessPool:
+        # A crashed worker (segfault, OOM kill) breaks the whole pool for good
+        if pdf_pool is pool:
+            pdf_pool = None
+            pool.shutdown(wait=False)
+        raise
+
+
+async def parse_pdf(file_path):
+    """Parses a PDF into text chunks, one page window per task."""
+    page_count = await asyncio.to_thread(count_pages, file_path)
+    windows = await asyncio.gather(*(
+        parse_pages(file_path, start, min(start + PDF_PAGE_WINDOW, page_count))
+        for start in range(0, page_count, PDF_PAGE_WINDOW)
+    ))
+    return [chunk for chunks in windows for chunk in chunks]
+
+# Chunks are embedded in batches with a bounded number of requests in flight,
+# so an upload costs a few round-trips instead of one per chunk.
+EMBEDDING_BATCH_SIZE = 100
+EMBEDDING_CONCURRENCY = 10
+
+
+async def embed_documents(texts, semaphore):
+    """Embeds texts in batches, in input order, with the semaphore bounding batches in flight."""
+
+    async def embed_batch(batch):
+        async with semaphore:
+            return await embeddings.aembed_documents(batch)
+
+    batches = [texts[i:i + EMBEDDING_BATCH_SIZE] for i in range(0, len(texts), EMBEDDING_BATCH_SIZE)]
+    results = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+    return normalize([vector for batch_vectors in results for vector in batch_vectors]).tolist()
+
+# Small corpora use an exact flat index. Past IVF_PQ_MIN_VECTORS chunks the
+# index switches to IVF+PQ, which only scans a few clusters of compressed vectors.
+IVF_PQ_MIN_VECTORS = 10000
+IVF_PQ_SUBQUANTIZERS = 16
+IVF_PQ_BITS = 8
+IVF_PQ_NPROBE = 8
+
+
+async def build_vector_store(paths):
+    """Parses, embeds and indexes PDFs, embedding each file's chunks as soon as it is parsed."""
+    semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+
+    async def parse_and_embed(path):
+        docs = await parse_pdf(path)
+        if not docs:
+            return docs, []
+        return docs, await embed_documents([doc.page_content for doc in docs], semaphore)
+
+    results = await asyncio.gather(*(parse_and_embed(path) for path in paths))
+    docs = [doc for file_docs, _ in results for doc in file_docs]
+    vectors = [vector for _, file_vectors in results for vector in file_vectors]
+    text_embeddings = list(zip([doc.page_content for doc in docs], vectors))
+    # Index construction is CPU-bound, so keep it off the event loop
+    return await asyncio.to_thread(index_vectors, text_embeddings, [doc.metadata for doc in docs])
+
+
+def index_vectors(text_embeddings, metadatas):
+    """Builds a FAISS vector store from precomputed (text, vector) pairs."""
+    vectors = [vector for _, vector in text_embeddings]
+    dimension = len(vectors[0])
+    if len(vectors) < IVF_PQ_MIN_VECTORS or dimension % IVF_PQ_SUBQUANTIZERS:
+        return FAISS.from_embeddings(
+            text_embeddings, embeddings, metadatas=metadatas, distance_strategy=DISTANCE_STRATEGY
+        )
+
+    # FAISS wants ~39 training points per centroid; fewer leave lists under-trained
+    nlist = min(4096, 4 * int(math.sqrt(len(vectors))), len(vectors) // 39)
+    quantizer = faiss.IndexFlatIP(dimension)
+    index = faiss.IndexIVFPQ(
+        quantizer, dimension, nlist, IVF_PQ_SUBQUANTIZERS, IVF_PQ_BITS, faiss.METRIC_INNER_PRODUCT
+    )
+    index.train(np.asarray(vectors, dtype=np.float32))
+    index.nprobe = IVF_PQ_NPROBE
+
+    vector_store = FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=InMemoryDocstore(),
+        index_to_docstore_id={},
+        distance_strategy=DISTANCE_STRATEGY,
+    )
+    vector_store.add_embeddings(text_embeddings, metadatas=metadatas)
+    set_search_params(vector_store)
+    return vector_store
+
+# Built indexes are saved under FAISS_INDEX_DIR, keyed by a hash of the uploaded
+# files, so uploading the same documents again skips parsing and embedding. Only
+# the FAISS_INDEX_MAX_SAVED most recently used indexes are kept.
+FAISS_INDEX_DIR = os.getenv("FAISS_INDEX_DIR", os.path.join(tempfile.gettempdir(), "faiss_index"))
+FAISS_INDEX_MAX_SAVED = 64
+STAGING_PREFIX = ".staging-"
+# Bump when chunking or index construction changes so older saved indexes are
+# not reused (v2: pages split one at a time, v3: pages read directly with
+# pypdfium2 and line endings normalized)
+INDEX_PIPELINE_VERSION = 3
+STAGING_MAX_AGE = 60 * 60  # 1 hour
+
+
+def corpus_key(paths):
+    """Hashes the pipeline version, embedding model, metric and uploaded files into a key for the saved index."""
+    digest = hashlib.blake2b(
+        f"{INDEX_PIPELINE_VERSION}\0{EMBEDDING_MODEL}\0{DISTANCE_STRATEGY.value}".encode("utf-8")
+    )
+    for path in paths:
+        digest.update(os.path.basename(path).encode("utf-8"))
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def is_saved_index(index_path):
+    """Returns whether index_path holds a completely saved vector store."""
+    return all(os.path.isfile(os.path.join(index_path, name)) for name in ("index.faiss", "index.pkl"))
+
+
+def save_vector_store(vector_store, index_path):
+    """Saves a vector store under index_path atomically, then evicts old saved indexes."""
+    # Write into a staging directory and rename it into place, so a crash or a
+    # concurrent upload of the same files never leaves a half-written index
+    staging_path = tempfile.mkdtemp(prefix=STAGING_PREFIX, dir=FAISS_INDEX_DIR)
+    try:
+        vector_store.save_local(staging_path)
+        if not is_saved_index(index_path):
+            shutil.rmtree(index_path, ignore_errors=True)
+            os.replace(staging_path, index_path)
+    finally:
+        shutil.rmtree(staging_path, ignore_errors=True)
+    evict_saved_indexes()
+
+
+def evict_saved_indexes():
+    """Deletes all but the most recently used saved indexes, and stale staging directories."""
+    saved = []
+    for entry in os.scandir(FAISS_INDEX_DIR):
+        if not entry.is_dir():
+            continue
+        if entry.name.startswith(STAGING_PREFIX):
+            if entry.stat().st_mtime < time.time() - STAGING_MAX_AGE:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            saved.append(entry)
+    saved.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in saved[FAISS_INDEX_MAX_SAVED:]:
+        shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def load_vector_store(index_path):
+    """Loads a vector store saved with save_local, memory-mapping the FAISS index when possible."""
+    # Memory-mapped vectors are paged in on demand, but an mmap-loaded IVF index
+    # cannot be serialized back out, so sessions stored in Redis read it fully
+    io_flags = 0 if redis_client else faiss.IO_FLAG_MMAP
+    index = faiss.read_index(os.path.join(index_path, "index.faiss"), io_flags)
+    with open(os.path.join(index_path, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    vector_store = FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id=index_to_docstore_id,
+        distance_strategy=DISTANCE_STRATEGY,
+    )
+    set_search_params(vector_store)
+    # Mark the index as recently used so eviction keeps it
+    os.utime(index_path)
+    return vector_store
+
+
+def set_search_params(vector_store):
+    """Applies search settings that are not saved with a serialized FAISS index."""
+    if isinstance(vector_store.index, faiss.IndexIVF):
+        vector_store.index.nprobe = IVF_PQ_NPROBE
+        # MMR reconstructs candidate vectors by position, which IVF needs a direct map for
+        if vector_store.index.direct_map.no():
+            vector_store.index.make_direct_map()
+
+# Session vector stores expire after SESSION_TTL seconds of inactivity. The most
+# recently used ones are kept deserialized in-process to avoid repeated loads.
+SESSION_TTL = 60 * 60  # 1 hour
+SESSION_CACHE_SIZE = 32
+
+
+def save_session(session_id, vector_store):
+    """Stores a session's vector store in Redis, or in memory without Redis."""
+    if redis_client:
+        redis_client.set(f"vs:{session_id}", vector_store.serialize_to_bytes(), ex=SESSION_TTL)
+    else:
+        vector_stores[session_id] = vector_store
+
+
+def load_session(session_id):
+    """Returns a session's vector store, or None if the session is unknown or expired."""
+    if not redis_client:
+        return vector_stores.get(session_id)
+    # Refreshing the TTL also tells us whether the session still exists
+    if not redis_client.expire(f"vs:{session_id}", SESSION_TTL):
+        return None
+    return deserialize_session(session_id)
+
+
+@functools.lru_cache(maxsize=SESSION_CACHE_SIZE)
+def deserialize_session(session_id):
+    """Deserializes a session's vector store from Redis."""
+    vector_store = FAISS.deserialize_from_bytes(
+        redis_client.get(f"vs:{session_id}"),
+        embeddings,
+        allow_dangerous_deserialization=True,
+        distance_strategy=DISTANCE_STRATEGY,
+    )
+    set_search_params(vector_store)
+    return vector_store
+
+RETRIEVAL_K = 4
+RETRIEVAL_FETCH_K = 20
+RETRIEVAL_LAMBDA_MULT = 0.5
+
+# MMR returns chunks in selection order. They are reordered by similarity to the
+# query, and chunks below MIN_SIMILARITY are dropped; if none are left the query
+# is answered without calling the LLM. No floor has been measured against real
+# queries yet, so the default of 0.0 only drops chunks pointing away from the
+# query; raise MIN_SIMILARITY once a threshold is validated on labelled data.
+MIN_SIMILARITY = float(os.getenv("MIN_SIMILARITY", "0.0"))
+INSUFFICIENT_CONTEXT_ANSWER = "The provided documents do not contain enough relevant information to answer this query."
+
+
+def rerank(docs_and_scores):
+    """Orders retrieved documents by similarity and drops those below MIN_SIMILARITY."""
+    # Scores are inner products of normalized vectors, i.e. cosine similarities
+    ranked = sorted(docs_and_scores, key=lambda pair: pair[1], reverse=True)
+    return [(doc, float(score)) for doc, score in ranked if score >= MIN_SIMILARITY]
+
+# Retrieved chunks are packed into the prompt, most similar first, until the
+# token budget is reached; prompt length drives most of the LLM latency.
+# tiktoken downloads its encoding on first use, so it is loaded lazily and
+# offline deploys fall back to estimating ~4 characters per token.
+CONTEXT_TOKEN_BUDGET = 2048
+CHARS_PER_TOKEN = 4
+SENTENCE_END = re.compile(r"[.!?](?=\s|$)")
+
+
+@functools.lru_cache(maxsize=1)
+def get_tokenizer():
+    """Returns the cl100k_base tokenizer, or None if it cannot be loaded."""
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        print(f"Error loading tokenizer, estimating tokens from characters: {e}")
+        return None
+
+
+def build_context(docs):
+    """Joins retrieved chunks into a prompt context that fits the token budget."""
+    tokenizer = get_tokenizer()
+    parts = []
+    remaining = CONTEXT_TOKEN_BUDGET
+    for doc in docs:
+        text = doc.page_content
+        if tokenizer:
+            tokens = tokenizer.encode(text)
+            token_count = len(tokens)
+        else:
+            token_count = math.ceil(len(text) / CHARS_PER_TOKEN)
+        if token_count <= remaining:
+            parts.append(text)
+            remaining -= token_count
+            continue
+
+        # Keep whole sentences from the chunk that overflows the budget
+        if tokenizer:
+            truncated = tokenizer.decode(tokens[:remaining])
+        else:
+            truncated = text[:remaining * CHARS_PER_TOKEN]
+        sentence_ends = [match.end() for match in SENTENCE_END.finditer(truncated)]
+        if sentence_ends:
+            parts.append(truncated[:sentence_ends[-1]])
+        break
+    return "\n".join(parts)
+
+# Both RAG chains are built once at import. Short queries whose best match is
+# very close go to the smaller Flash-8B model; everything else uses full Flash.
+RAG_PROMPT = PromptTemplate.from_template("""
+            You are an expert document evaluator. Your task is to analyze a user's query against a set of relevant clauses from a document they provided.
+            Here are the relevant clauses:
+            ---
+            {context}
+            ---
+            Here is the user's query:
+            ---
+            {query}
+            ---
+            Based *only* on the provided context from the document, answer the user's query. If the context is not sufficient to answer, state that.
+            Provide a clear and concise answer.
+            """)
+FLASH_MODEL = "gemini-1.5-flash-latest"
+FLASH_8B_MODEL = "gemini-1.5-flash-8b"
+RAG_CHAINS = {
+    model: ChatGoogleGenerativeAI(model=model, temperature=0, convert_system_message_to_human=True) | StrOutputParser()
+    for model in (FLASH_MODEL, FLASH_8B_MODEL)
+}
+ROUTER_MAX_QUERY_LENGTH = 120
+ROUTER_MIN_SIMILARITY = 0.85
+
+
+def select_model(user_query, top_similarity):
+    """Picks the Gemini model for a query based on its length and best retrieval match."""
+    if len(user_query) < ROUTER_MAX_QUERY_LENGTH and top_similarity > ROUTER_MIN_SIMILARITY:
+        return FLASH_8B_MODEL
+    return FLASH_MODEL
+
+# Generation must finish within ANSWER_TIMEOUT seconds, leaving headroom under
+# vercel.json's 300 s maxDuration for retrieval and the final SSE event.
+ANSWER_TIMEOUT = 240
+
+
+async def with_deadline(stream, timeout):
+    """Yields items from an async iterator, raising TimeoutError once timeout seconds have passed."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    iterator = stream.__aiter__()
+    while True:
+        try:
+            item = await asyncio.wait_for(iterator.__anext__(), max(deadline - loop.time(), 0))
+        except StopAsyncIteration:
+            return
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Answer not finished within {timeout} s") from None
+        yield item
+
+
+async def read_llm_cache(prompt, model):
+    """Returns the cached answer for a prompt and model, or None on a miss or cache error."""
+    try:
+        generations = await llm_cache.alookup(prompt, model)
+    except Exception as e:
+        print(f"Error reading LLM cache: {e}")
+        return None
+    return generations[0].text if generations else None
+
+
+async def write_llm_cache(prompt, model, answer):
+    """Stores a completed answer in the LLM cache, logging rather than raising on errors."""
+    try:
+        await llm_cache.aupdate(prompt, model, [Generation(text=answer)])
+    except Exception as e:
+        print(f"Error writing LLM cache: {e}")
+
+# --- 4. CREATE THE API ENDPOINTS ---
 
 @app.route('/upload', methods=['POST'])
-def upload_files():
+async def upload_files():
     """Handles file uploads, creates a vector store, and returns a session ID."""
-    if 'files' not in request.files:
+    request_files = await request.files
+    if 'files' not in request_files:
         return jsonify({"error": "No files part in the request."}), 400
     
-    files = request.files.getlist('files')
+    files = request_files.getlist('files')
     if not files or all(f.filename == '' for f in files):
         return jsonify({"error": "No selected files."}), 400
 
-    saved_paths = []
-    all_documents = []
-    
-    for file in files:
-        if file and file.filename.endswith('.pdf'):
-            filename = secure_filename(file.filename)
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(file_path)
+    if not all(file and file.filename.endswith('.pdf') for file in files):
+        return jsonify({"error": "Invalid file type. Only PDFs are accepted."}), 400
+
+    # Each request saves into its own directory, so concurrent uploads of files
+    # with the same name cannot overwrite or delete each other's copies
+    upload_dir = tempfile.mkdtemp(dir=app.config['UPLOAD_FOLDER'])
+    try:
+        saved_paths = []
+        for file in files:
+            file_path = os.path.join(upload_dir, secure_filename(file.filename))
+            await file.save(file_path)
             saved_paths.append(file_path)
-            
-            # Load documents from the saved PDF
-            loader = PyPDFLoader(file_path)
-            all_documents.extend(loader.load())
+
+        try:
+            index_dir = await asyncio.to_thread(private_dir, FAISS_INDEX_DIR)
+            index_path = os.path.join(index_dir, await asyncio.to_thread(corpus_key, saved_paths))
+        except OSError as e:
+            # Without a trusted index directory, indexes are built but never saved or reused
+            print(f"Saved indexes unavailable: {e}")
+            index_path = None
+
+        if index_path and await asyncio.to_thread(is_saved_index, index_path):
+            # These exact files were indexed before, so reuse the saved index
+            vector_store = await asyncio.to_thread(load_vector_store, index_path)
         else:
-            return jsonify({"error": "Invalid file type. Only PDFs are accepted."}), 400
+            # Create vector store from the uploaded documents
+            vector_store = await build_vector_store(saved_paths)
+            if index_path:
+                try:
+                    await asyncio.to_thread(save_vector_store, vector_store, index_path)
+                except Exception as e:
+                    # The index is still usable for this session, it just won't be reused
+                    print(f"Error saving vector store: {e}")
 
-    try:
-        # Create vector store from the uploaded documents
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
-        docs = text_splitter.split_documents(all_documents)
-        embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
-        vector_store = FAISS.from_documents(docs, embeddings)
-        
-        # Clean up saved files after processing
-        for path in saved_paths:
-            os.remove(path)
-            
         # Create a unique session ID and store the vector store
         session_id = str(uuid.uuid4())
-        vector_stores[session_id] = vector_store
+        await asyncio.to_thread(save_session, session_id, vector_store)
         
         return jsonify({"message": "Files processed successfully.", "session_id": session_id})
         
@@ -84,52 +659,78 @@ def upload_files():
         print(f"Error creating vector store: {e}")
         return jsonify({"error": "Failed to process files."}), 500
 
+    finally:
+        # Clean up saved files after processing, whether or not it succeeded
+        CLEANUP_POOL.submit(remove_upload_dir, upload_dir)
+
 
 @app.route('/query', methods=['POST'])
-def query_documents():
-    """Receives a query and session ID, and returns the evaluation."""
-    data = request.get_json()
+async def query_documents():
+    """Receives a query and session ID, and streams the evaluation as server-sent events."""
+    data = await request.get_json()
     if not data or 'query' not in data or 'session_id' not in data:
         return jsonify({"error": "Missing 'query' or 'session_id' in request body."}), 400
 
     session_id = data['session_id']
     user_query = data['query']
     
-    if session_id not in vector_stores:
+    try:
+        vector_store = await asyncio.to_thread(load_session, session_id)
+    except Exception as e:
+        print(f"Error loading session: {e}")
+        return jsonify({"error": "Failed to process query."}), 500
+
+    if vector_store is None:
         return jsonify({"error": "Invalid or expired session ID."}), 404
-        
-    vector_store = vector_stores[session_id]
 
     try:
-        # The RAG chain logic from before
-        rag_chain = LLMChain(
-            llm=ChatGoogleGenerativeAI(model="gemini-1.5-flash-latest", temperature=0, convert_system_message_to_human=True),
-            prompt=PromptTemplate.from_template("""
-            You are an expert document evaluator. Your task is to analyze a user's query against a set of relevant clauses from a document they provided.
-            Here are the relevant clauses:
-            ---
-            {context}
-            ---
-            Here is the user's query:
-            ---
-            {query}
-            ---
-            Based *only* on the provided context from the document, answer the user's query. If the context is not sufficient to answer, state that.
-            Provide a clear and concise answer.
-            """)
+        query_vector = await embed_query(user_query)
+        # MMR picks diverse chunks from a wider pool so near-duplicates don't fill the prompt
+        docs_and_scores = await vector_store.amax_marginal_relevance_search_with_score_by_vector(
+            query_vector, k=RETRIEVAL_K, fetch_k=RETRIEVAL_FETCH_K, lambda_mult=RETRIEVAL_LAMBDA_MULT
         )
+        docs_and_scores = rerank(docs_and_scores)
+        relevant_docs = [doc for doc, _ in docs_and_scores]
+        context = build_context(relevant_docs)
 
-        relevant_docs = vector_store.similarity_search(user_query)
-        context = "\n".join([doc.page_content for doc in relevant_docs])
-        
-        result = rag_chain.invoke({"context": context, "query": user_query})
-        
-        return jsonify({"answer": result.get('text', 'No answer found.')})
+        top_similarity = docs_and_scores[0][1] if docs_and_scores else 0.0
+        model = select_model(user_query, top_similarity)
+        prompt = RAG_PROMPT.format(context=context, query=user_query)
         
     except Exception as e:
         print(f"Error during query: {e}")
         return jsonify({"error": "Failed to process query."}), 500
 
-# This allows Vercel/Render to run the Flask app
+    async def stream_answer():
+        if not docs_and_scores:
+            yield f"data: {orjson.dumps({'token': INSUFFICIENT_CONTEXT_ANSWER}).decode()}\n\n"
+            yield "event: done\ndata: {}\n\n"
+            return
+        try:
+            # Every chain runs at temperature 0, so the model name identifies the LLM settings
+            cached = await read_llm_cache(prompt, model)
+            if cached is not None:
+                yield f"data: {orjson.dumps({'token': cached}).decode()}\n\n"
+            else:
+                tokens = []
+                async for token in with_deadline(RAG_CHAINS[model].astream(prompt), ANSWER_TIMEOUT):
+                    tokens.append(token)
+                    yield f"data: {orjson.dumps({'token': token}).decode()}\n\n"
+                await write_llm_cache(prompt, model, "".join(tokens))
+            yield "event: done\ndata: {}\n\n"
+        except Exception as e:
+            print(f"Error during query: {e}")
+            yield f"event: error\ndata: {orjson.dumps({'error': 'Failed to process query.'}).decode()}\n\n"
+
+    # Quart's RESPONSE_TIMEOUT would cut the stream off silently; with_deadline
+    # enforces ANSWER_TIMEOUT instead so the client still gets an error event
+    response = Response(stream_answer(), mimetype="text/event-stream")
+    response.timeout = None
+    return response
+
+# This allows Vercel/Render to run the Quart app; in production serve it with
+# `uvicorn app:app --workers N --loop uvloop`. Under `python app.py` each spawned
+# PDF worker re-imports this script, repeating the module setup above (but not
+# the embedding model, which loads on first use).
 if __name__ == "__main__":
     app.run(debug=True)
\ No newline at end of file
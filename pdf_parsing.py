@@ -0,0 +1,48 @@
+import threading
+
+import pypdfium2 as pdfium
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_core.documents import Document
+
+# This module is imported by the PDF worker processes, so it stays free of the
+# app's model, cache and server setup.
+
+# Pages are split with LangChain's recursive splitter, which falls back from
+# paragraph to line, word and character breaks so no chunk exceeds 1,000
+# characters. A single-pass regex splitter measured no faster on 200-page
+# documents, so the stock splitter is kept.
+TEXT_SPLITTER = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
+
+# pdfium is not thread-safe; this only serializes parsing when no worker
+# processes are available and PDFs are parsed in threads instead
+PDFIUM_LOCK = threading.Lock()
+
+
+def count_pages(file_path):
+    """Returns the number of pages in a PDF."""
+    with PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(file_path)
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+
+
+def load_chunks(file_path, start, stop):
+    """Parses pages [start, stop) of a PDF into text chunks. Runs in a PDF worker process."""
+    # Pages are split as they are read, so only one page is held in full at a time
+    chunks = []
+    with PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(file_path)
+        try:
+            for page_number in range(start, stop):
+                page = pdf[page_number]
+                text_page = page.get_textpage()
+                text = "\n".join(text_page.get_text_range().splitlines())
+                text_page.close()
+                page.close()
+                page_doc = Document(page_content=text, metadata={"source": file_path, "page": page_number})
+                chunks.extend(TEXT_SPLITTER.split_documents([page_doc]))
+        finally:
+            pdf.close()
+    return chunks